@@ -17,10 +17,13 @@ Endpoints:
 - `/`: Renders the HTML UI.
 - `/preview_tile_count`: Calculates how many tiles will be downloaded (with margin).
 - `/download_tiles`: Downloads the tiles in the specified format (ZIP or MBTiles).
+- `/download_tiles_stream`: Streams a ZIP of the tiles to the client while they download.
 
 Note:
 - Be respectful to the OpenStreetMap tile server (includes custom User-Agent).
 - If using this for heavy downloads, consider setting up your own tile server.
+- Job state and output files live in this process, so run a single server process
+  (e.g. `python app.py`, or one gunicorn worker with threads).
 
 """
 import os
@@ -34,7 +37,15 @@ import threading
 import time
 import tempfile
 import random
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import string
+import json
+import hashlib
+import queue
+import atexit
+from itertools import product
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
 from flask import Flask, request, send_file, render_template, jsonify
 
 app = Flask(__name__)
@@ -47,22 +58,217 @@ TILE_SERVERS = {
 USER_AGENT = "OfflineTileDownloader/1.0 (+mailto:you@example.com)"
 MAX_TILE_COUNT = 20000
 TILE_MARGIN = 1
-REQUEST_DELAY = 0.1  # 100ms delay between requests
-MAX_WORKERS = 4  # Number of concurrent download threads
+REQUEST_RATE = 10  # Max requests per second to each tile server
+MAX_WORKERS = 16  # Number of concurrent download threads (cache hits don't touch the network)
+MAX_CONNECTIONS_PER_HOST = 4  # Max in-flight requests per tile server
+ZIP_SPOOL_SIZE = 64 * 1024 * 1024  # ZIP archives larger than this spill to a temp file
+MBTILES_BATCH_SIZE = 500  # Tile rows buffered per executemany() call
+WRITE_QUEUE_SIZE = 256  # Downloaded tiles buffered between download workers and the writer thread
+PROGRESS_KEEPALIVE = 15  # Seconds between SSE keepalive comments when progress is idle
+JOB_TTL = 30 * 60  # Seconds a finished job (and its file) is kept if never downloaded
+JOB_JANITOR_INTERVAL = 60  # Seconds between sweeps for expired jobs
+MAX_CONCURRENT_JOBS = 2  # Download jobs run at once; further jobs wait in the queue
+MAX_CONCURRENT_STREAMS = 2  # Streamed ZIP downloads run at once; further streams are refused
+STREAM_IDLE_TIMEOUT = 60  # Seconds a stream's client may stop reading before its downloads are cancelled
+
+# Shared HTTP session so every worker reuses pooled keep-alive connections
+# instead of paying a fresh TCP/TLS handshake per tile.
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": USER_AGENT})
+SESSION.mount("https://", HTTPAdapter(pool_connections=len(TILE_SERVERS), pool_maxsize=MAX_CONNECTIONS_PER_HOST, max_retries=0))
+
+def compile_url_template(url_template):
+    """Split a tile URL template once into a build_url(z, x, y) that only concatenates.
+
+    Templates using each of {z}, {x} and {y} exactly once, without format specs or
+    conversions, are pre-split; anything else falls back to str.format so custom
+    tile servers keep their exact formatting.
+    """
+    def format_url(z, x, y):
+        return url_template.format(z=z, x=x, y=y)
+
+    # Escaped braces come back as extra literal-only chunks, so merge literals
+    # between placeholders
+    literals = [""]
+    fields = []
+    for literal, field, spec, conversion in string.Formatter().parse(url_template):
+        literals[-1] += literal
+        if field is None:
+            continue
+        if spec or conversion or field not in ("z", "x", "y"):
+            return format_url
+        fields.append(field)
+        literals.append("")
+    if sorted(fields) != ["x", "y", "z"]:
+        return format_url
+    head, tail0, tail1, tail2 = literals
+    i0, i1, i2 = ("zxy".index(field) for field in fields)
+
+    def build_url(z, x, y):
+        coords = (z, x, y)
+        return f"{head}{coords[i0]}{tail0}{coords[i1]}{tail1}{coords[i2]}{tail2}"
+
+    return build_url
+
+# Templates are parsed once here instead of by str.format on every tile
+URL_BUILDERS = {style: compile_url_template(url_template) for style, url_template in TILE_SERVERS.items()}
+
+# Caps in-flight requests per tile server independently of the worker count
+HOST_LIMITS = {
+    urlsplit(url_template).netloc: threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)
+    for url_template in TILE_SERVERS.values()
+}
 
-download_progress = {}
+class TokenBucket:
+    """Thread-safe rate limiter allowing `rate` acquisitions per second, in bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping only if the bucket is empty."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Going negative reserves the next token, so waiters are served in order
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+# Shared per-host request rate across all workers and jobs
+HOST_RATE_LIMITS = {
+    urlsplit(url_template).netloc: TokenBucket(REQUEST_RATE, MAX_CONNECTIONS_PER_HOST)
+    for url_template in TILE_SERVERS.values()
+}
 
-def download_tile_with_retry(url, headers, max_retries=3):
-    """Download a tile with exponential backoff retry logic."""
+def discard_job_file(file_obj):
+    """Release a job's output: delete an MBTiles path or close a ZIP temp file."""
+    if isinstance(file_obj, str):
+        if os.path.exists(file_obj):
+            os.unlink(file_obj)
+    elif file_obj is not None:
+        file_obj.close()
+
+class TempFileReader(io.FileIO):
+    """Read-only handle on a job's MBTiles file that deletes the file once closed."""
+
+    def __init__(self, path):
+        super().__init__(path, 'r')
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            if os.path.exists(self.name):
+                os.unlink(self.name)
+
+class JobStore:
+    """Thread-safe registry of download jobs that evicts finished jobs after a TTL."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._jobs = {}
+        self.updated = threading.Condition()  # Notified whenever any job changes
+
+    def create(self):
+        job_id = str(uuid.uuid4())
+        with self.updated:
+            self._jobs[job_id] = {"progress": 0, "total": 1, "done": False, "error": None,
+                                  "file": None, "finished_at": None}
+        return job_id
+
+    def get(self, job_id):
+        """Return a copy of the job's state, or None if it is unknown or evicted."""
+        with self.updated:
+            prog = self._jobs.get(job_id)
+            return dict(prog) if prog else None
+
+    def update(self, job_id, **fields):
+        """Update a job's state and wake any /progress streams waiting on it."""
+        with self.updated:
+            prog = self._jobs.get(job_id)
+            if prog is None:
+                return
+            prog.update(fields)
+            if prog["done"] or prog["error"]:
+                prog["finished_at"] = time.monotonic()
+            self.updated.notify_all()
+
+    def claim_file(self, job_id):
+        """Remove a finished job from the store and return its state, handing its file to the caller.
+
+        If the job's file isn't ready the job is left in place and its current
+        state is returned; unknown jobs return None.
+        """
+        with self.updated:
+            prog = self._jobs.get(job_id)
+            if prog is None:
+                return None
+            if prog["file"] is not None:
+                del self._jobs[job_id]
+                self.updated.notify_all()
+            return dict(prog)
+
+    def pop(self, job_id):
+        """Forget a job and release its output file."""
+        with self.updated:
+            prog = self._jobs.pop(job_id, None)
+            self.updated.notify_all()
+        if prog:
+            discard_job_file(prog["file"])
+
+    def evict_expired(self):
+        now = time.monotonic()
+        with self.updated:
+            expired = [job_id for job_id, prog in self._jobs.items()
+                       if prog["finished_at"] is not None and now - prog["finished_at"] > self.ttl]
+        for job_id in expired:
+            print(f"Evicting expired job {job_id}")
+            self.pop(job_id)
+
+    def clear(self):
+        with self.updated:
+            job_ids = list(self._jobs)
+        for job_id in job_ids:
+            self.pop(job_id)
+
+jobs = JobStore(JOB_TTL)
+atexit.register(jobs.clear)
+
+def evict_expired_jobs():
+    """Background janitor that drops finished jobs nobody downloaded."""
+    while True:
+        time.sleep(JOB_JANITOR_INTERVAL)
+        jobs.evict_expired()
+
+threading.Thread(target=evict_expired_jobs, daemon=True).start()
+
+# Background download jobs share one bounded pool instead of a new thread per request
+JOB_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS, thread_name_prefix="download-job")
+
+# Streamed downloads get their own slots so clients that stall can't starve queued jobs
+STREAM_SLOTS = threading.BoundedSemaphore(MAX_CONCURRENT_STREAMS)
+
+def download_tile_with_retry(url, session, headers=None, max_retries=3):
+    """Download a tile with exponential backoff retry logic.
+
+    Returns the 200 (or, for conditional requests, 304) response, or None on failure.
+    """
+    host = urlsplit(url).netloc
+    host_limit = HOST_LIMITS[host]
+    host_rate_limit = HOST_RATE_LIMITS[host]
     for attempt in range(max_retries):
         try:
-            # Add base delay plus jitter to avoid thundering herd
-            jitter = random.uniform(0, 0.1)
-            time.sleep(REQUEST_DELAY + jitter)
-            
-            r = requests.get(url, headers=headers, timeout=10)
-            if r.status_code == 200:
-                return r.content
+            with host_limit:
+                host_rate_limit.acquire()
+                r = session.get(url, headers=headers, timeout=10)
+            if r.status_code in (200, 304):
+                return r
             elif r.status_code == 429:  # Too Many Requests
                 wait_time = (2 ** attempt) + random.uniform(0, 1)
                 print(f"Rate limited on {url}, waiting {wait_time:.2f}s before retry {attempt + 1}")
@@ -88,30 +294,87 @@ def download_tile_with_retry(url, headers, max_retries=3):
     
     return None
 
-def download_single_tile(z, x, y, map_style, job_id):
-    """Download a single tile and return the tile info and data."""
+def scan_tile_cache(tiles, map_style):
+    """Return the set of tiles already cached on disk.
+
+    Each tiles/{style}/{z}/{x} directory is listed once, so workers can check the
+    cache with a set lookup instead of a stat() per tile.
+    """
+    cached = set()
+    for z, x in {(z, x) for z, x, _ in tiles}:
+        tile_dir = f'tiles/{map_style}/{z}/{x}'
+        try:
+            with os.scandir(tile_dir) as entries:
+                for entry in entries:
+                    name = entry.name
+                    if name.endswith('.png') and name[:-4].isdigit():
+                        cached.add((z, x, int(name[:-4])))
+        except FileNotFoundError:
+            # Nothing cached for this column yet; write_atomic creates it on first download
+            pass
+    return frozenset(cached)
+
+def write_atomic(path, data):
+    """Write via a temp file so an interrupted write never leaves a partial file."""
+    tmp_path = f'{path}.tmp.{os.getpid()}.{threading.get_ident()}'
+    try:
+        f = open(tmp_path, 'wb')
+    except FileNotFoundError:
+        # First tile written to this directory
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = open(tmp_path, 'wb')
+    with f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def conditional_headers(tile_path):
+    """Build If-None-Match/If-Modified-Since headers from a cached tile's .etag sidecar."""
+    try:
+        with open(f'{tile_path}.etag') as f:
+            validators = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+def download_single_tile(z, x, y, map_style, job_id, cached_tiles, build_url, revalidate=False, session=SESSION):
+    """Download a single tile and return the tile info and data.
+
+    With revalidate, cached tiles are checked against the server with a
+    conditional GET and only re-downloaded if they changed.
+    """
     tile_base_path = f'tiles/{map_style}'
     tile_path = f'{tile_base_path}/{z}/{x}/{y}.png'
+    cached_data = None
+    headers = None
     
     # Check if tile already exists in cache
-    if os.path.exists(tile_path):
+    if (z, x, y) in cached_tiles:
         with open(tile_path, 'rb') as f:
-            return (z, x, y, f.read(), True)  # True indicates cached
+            cached_data = f.read()
+        if not revalidate:
+            return (z, x, y, cached_data, True)  # True indicates cached
+        headers = conditional_headers(tile_path)
     
     # Download tile
-    url_template = TILE_SERVERS.get(map_style, TILE_SERVERS["map"])
-    url = url_template.format(z=z, x=x, y=y)
-    headers = {"User-Agent": USER_AGENT}
+    url = build_url(z, x, y)
     
-    tile_data = download_tile_with_retry(url, headers)
-    if tile_data:
-        # Save to cache
-        os.makedirs(os.path.dirname(tile_path), exist_ok=True)
-        with open(tile_path, 'wb') as f:
-            f.write(tile_data)
-        return (z, x, y, tile_data, False)  # False indicates downloaded
-    else:
-        return (z, x, y, None, False)
+    r = download_tile_with_retry(url, session, headers)
+    if r is not None and r.status_code == 304 and cached_data:
+        return (z, x, y, cached_data, True)
+    if r is not None and r.status_code == 200 and r.content:
+        # Save to cache, plus the validators needed to revalidate it later, if the server sent any
+        write_atomic(tile_path, r.content)
+        validators = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+        if validators["etag"] or validators["last_modified"]:
+            write_atomic(f'{tile_path}.etag', json.dumps(validators).encode())
+        return (z, x, y, r.content, False)  # False indicates downloaded
+    # Fall back to the cached copy if revalidation failed
+    return (z, x, y, cached_data, cached_data is not None)
 
 @app.route('/')
 def index():
@@ -125,13 +388,11 @@ def preview_tile_count():
     if not bounds or not zoom_levels:
         return jsonify({"error": "Missing bounds or zoom levels"}), 400
 
+    corners = project_bounds(bounds)
     total = 0
-    for z in zoom_levels:
-        x1, y1 = deg2num(bounds['north'], bounds['west'], z)
-        x2, y2 = deg2num(bounds['south'], bounds['east'], z)
-        x_min, x_max = sorted([x1, x2])
-        y_min, y_max = sorted([y1, y2])
-        total += (x_max - x_min + 1 + TILE_MARGIN * 2) * (y_max - y_min + 1 + TILE_MARGIN * 2)
+    for z in dict.fromkeys(zoom_levels):
+        xs, ys = tile_range(corners, z)
+        total += len(xs) * len(ys)
 
         if total > MAX_TILE_COUNT:
             return jsonify({"error": f"Too many tiles: {total}"}), 400
@@ -145,66 +406,74 @@ def download_tiles():
     zoom_levels = data['zoom_levels']
     fmt = data.get('format', 'zip')
     map_style = data.get('map_style', 'map')  #
-    job_id = str(uuid.uuid4())
-    download_progress[job_id] = {"progress": 0, "total": 1, "done": False, "error": None, "file": None}
+    revalidate = bool(data.get('revalidate', False))
+    job_id = jobs.create()
 
     def worker():
         try:
-            tiles = []
-            for z in zoom_levels:
-                x1, y1 = deg2num(bounds['north'], bounds['west'], z)
-                x2, y2 = deg2num(bounds['south'], bounds['east'], z)
-                x_min, x_max = sorted([x1, x2])
-                y_min, y_max = sorted([y1, y2])
-                for x in range(x_min - TILE_MARGIN, x_max + 1 + TILE_MARGIN):
-                    for y in range(y_min - TILE_MARGIN, y_max + 1 + TILE_MARGIN):
-                        tiles.append((z, x, y))
-
-            download_progress[job_id]["total"] = len(tiles)
+            tiles = build_tile_list(bounds, zoom_levels)
+
+            jobs.update(job_id, total=len(tiles))
             
             print(f"Starting download of {len(tiles)} tiles for job {job_id}")
             if fmt == "mbtiles":
-                result = create_mbtiles(tiles, job_id, map_style)
+                result = create_mbtiles(tiles, job_id, map_style, revalidate)
             else:
-                result = create_zip(tiles, job_id, map_style)
+                result = create_zip(tiles, job_id, map_style, revalidate)
 
             if result:
-                download_progress[job_id]["done"] = True
-                download_progress[job_id]["file"] = result
-                download_progress[job_id]["format"] = fmt
-                download_progress[job_id]["style"] = map_style
+                jobs.update(job_id, file=result, format=fmt, style=map_style, done=True)
                 print(f"Download completed for job {job_id}")
             else:
-                download_progress[job_id]["error"] = "Failed to create file"
+                jobs.update(job_id, error="Failed to create file")
                 print(f"Failed to create file for job {job_id}")
 
         except Exception as e:
             error_msg = f"Download failed: {str(e)}"
-            download_progress[job_id]["error"] = error_msg
+            jobs.update(job_id, error=error_msg)
             print(f"Exception in worker for job {job_id}: {error_msg}")
 
-    threading.Thread(target=worker).start()
+    JOB_EXECUTOR.submit(worker)
     return jsonify({"job_id": job_id})
 
 @app.route('/progress/<job_id>')
 def progress(job_id):
+    def snapshot():
+        prog = jobs.get(job_id)
+        return prog and (prog['progress'], prog['total'], prog['done'], prog['error'])
+
     def generate():
+        last = ()
         while True:
-            prog = download_progress.get(job_id)
-            if not prog:
+            # Sleep until this job's progress changes instead of polling
+            with jobs.updated:
+                jobs.updated.wait_for(lambda: snapshot() != last, timeout=PROGRESS_KEEPALIVE)
+                state = snapshot()
+            if not state:
                 yield "data: error\n\n"
                 break
+            if state == last:
+                yield ": keepalive\n\n"
+                continue
 
-            yield f"data: {prog['progress']} / {prog['total']}\n\n"
-            if prog["done"] or prog["error"]:
+            last = state
+            progress_count, total, done, error = state
+            yield f"data: {progress_count} / {total}\n\n"
+            # Distinct final event: the file is only ready once the job is done,
+            # which can be well after the last tile is counted
+            if error:
+                yield "data: error\n\n"
+                break
+            if done:
+                yield "data: done\n\n"
                 break
-            time.sleep(0.5)
 
     return app.response_class(generate(), mimetype='text/event-stream')
 
 @app.route('/get_file/<job_id>')
 def get_file(job_id):
-    prog = download_progress.get(job_id)
+    # Claim the job so neither the janitor nor a second request can release the file mid-send
+    prog = jobs.claim_file(job_id)
     if not prog:
         print(f"get_file: Job {job_id} not found")
         return "Job not found", 404
@@ -219,109 +488,311 @@ def get_file(job_id):
     style_prefix = "map" if style == "map" else "satellite"
     filename = f"{style_prefix}_tiles.{file_type}"
 
-    return send_file(
+    # The file is released when the server closes it after sending: MBTiles paths
+    # are deleted by TempFileReader, ZIP spooled temp files delete themselves.
+    if isinstance(file_obj, str):
+        file_obj = TempFileReader(file_obj)
+    size = file_obj.seek(0, os.SEEK_END)
+    file_obj.seek(0)
+
+    response = send_file(
         file_obj,
         as_attachment=True,
         download_name=filename,
         mimetype="application/octet-stream"
     )
+    response.content_length = size
+    return response
 
-def create_zip(tiles, job_id, map_style):
-    zip_buffer = io.BytesIO()
-    completed_tiles = 0
-    
-    with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
-        # Use ThreadPoolExecutor for concurrent downloads
+@app.route('/download_tiles_stream', methods=['POST'])
+def download_tiles_stream():
+    data = request.get_json()
+    bounds = data.get('bounds')
+    zoom_levels = data.get('zoom_levels')
+    if not bounds or not zoom_levels:
+        return jsonify({"error": "Missing bounds or zoom levels"}), 400
+    map_style = data.get('map_style', 'map')
+    revalidate = bool(data.get('revalidate', False))
+
+    tiles = build_tile_list(bounds, zoom_levels)
+    if len(tiles) > MAX_TILE_COUNT:
+        return jsonify({"error": f"Too many tiles: {len(tiles)}"}), 400
+
+    if not STREAM_SLOTS.acquire(blocking=False):
+        return jsonify({"error": "Too many streaming downloads in progress, try again later"}), 503
+
+    style_prefix = "map" if map_style == "map" else "satellite"
+    print(f"Streaming {len(tiles)} tiles as ZIP")
+    return app.response_class(
+        stream_zip(tiles, map_style, revalidate),
+        mimetype="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={style_prefix}_tiles.zip"}
+    )
+
+def download_into_queue(tiles, job_id, map_style, revalidate, results, cancelled, idle_timeout=None):
+    """Download tiles on the worker pool, putting each (z, x, y, data, was_cached) result on results.
+
+    Workers block while the bounded queue is full, so downloads never run more than
+    the queue size plus MAX_WORKERS tiles ahead of the consumer. A None sentinel
+    follows the last result. Setting cancelled stops the remaining downloads; with
+    idle_timeout, it is set when a put stays blocked that long.
+    """
+    def put(item):
+        # Re-check cancellation so a consumer that went away can't leave workers blocked
+        blocked_since = time.monotonic()
+        while not cancelled.is_set():
+            try:
+                results.put(item, timeout=1)
+                return
+            except queue.Full:
+                if idle_timeout is not None and time.monotonic() - blocked_since > idle_timeout:
+                    if not cancelled.is_set():
+                        print(f"Consumer stopped reading for {idle_timeout}s, cancelling remaining downloads")
+                    cancelled.set()
+
+    def fetch(z, x, y):
+        if cancelled.is_set():
+            return
+        try:
+            result = download_single_tile(z, x, y, map_style, job_id, cached_tiles, build_url, revalidate)
+        except Exception as e:
+            print(f"Exception downloading tile {z}/{x}/{y}: {e}")
+            result = (z, x, y, None, False)
+        put(result)
+
+    try:
+        cached_tiles = scan_tile_cache(tiles, map_style)
+        build_url = URL_BUILDERS.get(map_style) or URL_BUILDERS["map"]  # Resolved once per job
         with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            # Submit all download tasks
-            future_to_tile = {
-                executor.submit(download_single_tile, z, x, y, map_style, job_id): (z, x, y)
-                for z, x, y in tiles
-            }
-            
-            # Process completed downloads
-            for future in as_completed(future_to_tile):
-                z, x, y = future_to_tile[future]
-                completed_tiles += 1
-                download_progress[job_id]["progress"] = completed_tiles
-                
-                try:
-                    result_z, result_x, result_y, tile_data, was_cached = future.result()
-                    if tile_data:
-                        zip_file.writestr(f'{z}/{x}/{y}.png', tile_data)
-                        if not was_cached:
-                            print(f"Downloaded tile {z}/{x}/{y}")
-                    else:
-                        print(f"Failed to download tile {z}/{x}/{y} after retries")
-                except Exception as e:
-                    print(f"Exception downloading tile {z}/{x}/{y}: {e}")
+            for z, x, y in tiles:
+                executor.submit(fetch, z, x, y)
+    finally:
+        put(None)  # Sentinel: every download has been queued
+
+def download_to_writer(tiles, job_id, map_style, revalidate, write_tile):
+    """Download tiles on the worker pool and pass each one to write_tile(z, x, y, data) on a writer thread.
+
+    Workers hand results over through a bounded queue, so a slow writer applies
+    backpressure instead of the whole job piling up in memory, and writes never
+    run in between collecting download results.
+    """
+    results = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+
+    def writer():
+        completed_tiles = 0
+        while (result := results.get()) is not None:
+            z, x, y, tile_data, was_cached = result
+            try:
+                if tile_data:
+                    write_tile(z, x, y, tile_data)
+                    if not was_cached:
+                        print(f"Downloaded tile {z}/{x}/{y}")
+                else:
+                    print(f"Failed to download tile {z}/{x}/{y} after retries")
+            except Exception as e:
+                print(f"Exception writing tile {z}/{x}/{y}: {e}")
+            completed_tiles += 1
+            jobs.update(job_id, progress=completed_tiles)
+
+    writer_thread = threading.Thread(target=writer, name=f"tile-writer-{job_id}")
+    writer_thread.start()
+    try:
+        download_into_queue(tiles, job_id, map_style, revalidate, results, threading.Event())
+    finally:
+        writer_thread.join()
+
+def create_zip(tiles, job_id, map_style, revalidate=False):
+    # Small archives stay in memory, large ones roll over to disk
+    zip_buffer = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_SIZE, suffix=".zip")
+    
+    # PNG tiles are already deflate-compressed, so store them as-is
+    date_time = time.localtime()[:6]
+    with zipfile.ZipFile(zip_buffer, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zip_file:
+        def write_tile(z, x, y, tile_data):
+            write_zip_tile(zip_file, z, x, y, tile_data, date_time)
+
+        download_to_writer(tiles, job_id, map_style, revalidate, write_tile)
 
     zip_buffer.seek(0)
-    return io.BytesIO(zip_buffer.read())
+    return zip_buffer
+
+def write_zip_tile(zip_file, z, x, y, tile_data, date_time):
+    info = zipfile.ZipInfo(f'{z}/{x}/{y}.png', date_time=date_time)
+    info.external_attr = 0o644 << 16
+    zip_file.writestr(info, tile_data)
+
+class ZipStream:
+    """Write-only file object that buffers ZipFile output until it is drained.
+
+    It has no tell()/seek(), so ZipFile writes entries with data descriptors
+    and never goes back to patch headers.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def stream_zip(tiles, map_style, revalidate=False):
+    """Start downloading tiles and return a generator yielding their ZIP archive piece by piece.
+
+    The caller must hold a STREAM_SLOTS slot. It is released when the downloads
+    finish, or are cancelled because the client disconnected or stopped reading
+    for STREAM_IDLE_TIMEOUT seconds.
+    """
+    # A small queue keeps only a handful of tiles in memory and lets the
+    # client's read speed throttle the downloads
+    results = queue.Queue(maxsize=MAX_WORKERS)
+    cancelled = threading.Event()
+
+    def produce():
+        try:
+            download_into_queue(tiles, None, map_style, revalidate, results, cancelled,
+                                idle_timeout=STREAM_IDLE_TIMEOUT)
+        finally:
+            STREAM_SLOTS.release()
 
-def create_mbtiles(tiles, job_id, map_style):
+    def generate():
+        stream = ZipStream()
+        date_time = time.localtime()[:6]
+        try:
+            zip_file = zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+            while True:
+                try:
+                    result = results.get(timeout=1)
+                except queue.Empty:
+                    if cancelled.is_set():
+                        # Downloads were abandoned; end without a central directory so
+                        # the client sees a truncated archive rather than a partial one
+                        return
+                    continue
+                if result is None:
+                    break
+                z, x, y, tile_data, was_cached = result
+                if tile_data:
+                    write_zip_tile(zip_file, z, x, y, tile_data, date_time)
+                else:
+                    print(f"Failed to download tile {z}/{x}/{y} after retries")
+                yield stream.drain()
+            # Central directory, written when the archive is closed
+            zip_file.close()
+            yield stream.drain()
+        finally:
+            # Stop remaining downloads if the client disconnected mid-stream
+            cancelled.set()
+
+    threading.Thread(target=produce, name="zip-stream", daemon=True).start()
+    return generate()
+
+def create_mbtiles(tiles, job_id, map_style, revalidate=False):
     tmpfile = tempfile.NamedTemporaryFile(delete=False, suffix=".mbtiles")
-    conn = sqlite3.connect(tmpfile.name)
+    # Tile rows are inserted from the writer thread, everything else from this one
+    conn = sqlite3.connect(tmpfile.name, check_same_thread=False)
+    # Scratch-file tuning: the file is thrown away if the job fails, so keep the
+    # rollback journal in memory and skip fsyncs. Every page is written once.
+    conn.execute("PRAGMA journal_mode=MEMORY")
+    conn.execute("PRAGMA synchronous=OFF")
     cursor = conn.cursor()
 
+    # Identical tiles (open ocean, blank areas) are stored once in images and
+    # referenced from map; the tiles view keeps the standard MBTiles interface.
     cursor.executescript("""
         CREATE TABLE metadata (name TEXT, value TEXT);
-        CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
-        CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);
+        CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT);
+        CREATE TABLE images (tile_id TEXT, tile_data BLOB);
+        CREATE VIEW tiles AS
+            SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,
+                   map.tile_row AS tile_row, images.tile_data AS tile_data
+            FROM map JOIN images ON images.tile_id = map.tile_id;
     """)
+    # Metadata and all tile rows go into a single transaction
+    cursor.execute("BEGIN")
     cursor.execute("INSERT INTO metadata (name, value) VALUES (?, ?)", ("name", "Offline Map"))
     cursor.execute("INSERT INTO metadata (name, value) VALUES (?, ?)", ("type", "baselayer"))
     cursor.execute("INSERT INTO metadata (name, value) VALUES (?, ?)", ("format", "png"))
 
-    completed_tiles = 0
-    
-    # Use ThreadPoolExecutor for concurrent downloads
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        # Submit all download tasks
-        future_to_tile = {
-            executor.submit(download_single_tile, z, x, y, map_style, job_id): (z, x, y)
-            for z, x, y in tiles
-        }
-        
-        # Process completed downloads
-        for future in as_completed(future_to_tile):
-            z, x, y = future_to_tile[future]
-            completed_tiles += 1
-            download_progress[job_id]["progress"] = completed_tiles
-            
-            try:
-                result_z, result_x, result_y, tile_data, was_cached = future.result()
-                if tile_data:
-                    # Convert to TMS y coordinate for MBTiles format
-                    tms_y = (2 ** z - 1) - y
-                    cursor.execute(
-                        "INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
-                        (z, x, tms_y, sqlite3.Binary(tile_data))
-                    )
-                    if not was_cached:
-                        print(f"Downloaded tile {z}/{x}/{y}")
-                else:
-                    print(f"Failed to fetch {z}/{x}/{y} after retries")
-            except Exception as e:
-                print(f"Exception downloading tile {z}/{x}/{y}: {e}")
-
+    insert_map = "INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)"
+    insert_images = "INSERT INTO images (tile_id, tile_data) VALUES (?, ?)"
+    pending_map = []
+    pending_images = []
+    seen_tile_ids = set()
+    # Highest row index per zoom level, for flipping XYZ y to the TMS rows MBTiles uses
+    tms_max = {z: (1 << z) - 1 for z in {tile[0] for tile in tiles}}
+
+    def flush_rows():
+        cursor.executemany(insert_images, pending_images)
+        cursor.executemany(insert_map, pending_map)
+        pending_images.clear()
+        pending_map.clear()
+
+    def write_tile(z, x, y, tile_data):
+        # Convert to TMS y coordinate for MBTiles format
+        tms_y = tms_max[z] - y
+        tile_id = hashlib.sha1(tile_data).hexdigest()
+        if tile_id not in seen_tile_ids:
+            seen_tile_ids.add(tile_id)
+            pending_images.append((tile_id, sqlite3.Binary(tile_data)))
+        pending_map.append((z, x, tms_y, tile_id))
+        if len(pending_map) >= MBTILES_BATCH_SIZE:
+            flush_rows()
+
+    download_to_writer(tiles, job_id, map_style, revalidate, write_tile)
+
+    flush_rows()
+
+    # Build the indexes once after the bulk load instead of updating them per insert
+    cursor.execute("CREATE UNIQUE INDEX map_index ON map (zoom_level, tile_column, tile_row)")
+    cursor.execute("CREATE UNIQUE INDEX images_id ON images (tile_id)")
     conn.commit()
     conn.close()
 
-    with open(tmpfile.name, 'rb') as f:
-        mb_data = f.read()
     tmpfile.close()
-    os.unlink(tmpfile.name)
 
-    return io.BytesIO(mb_data)
+    # Return the path rather than loading the database into memory;
+    # /get_file streams it from disk.
+    return tmpfile.name
 
 
-def deg2num(lat_deg, lon_deg, zoom):
+def project(lat_deg, lon_deg):
+    """Project a coordinate to Web Mercator, scaled so the world spans 0..1 at zoom 0."""
     lat_rad = math.radians(lat_deg)
-    n = 2.0 ** zoom
-    x = int((lon_deg + 180.0) / 360.0 * n)
-    y = int((1.0 - math.log(math.tan(lat_rad) + 1 / math.cos(lat_rad)) / math.pi) / 2.0 * n)
+    x = (lon_deg + 180.0) / 360.0
+    y = (1.0 - math.log(math.tan(lat_rad) + 1 / math.cos(lat_rad)) / math.pi) / 2.0
     return x, y
 
+def project_bounds(bounds):
+    """Project the north-west and south-east corners of bounds once for all zoom levels."""
+    return project(bounds['north'], bounds['west']) + project(bounds['south'], bounds['east'])
+
+def tile_range(corners, zoom):
+    """Return the x and y tile ranges covering projected corners at zoom, including TILE_MARGIN."""
+    n = float(1 << zoom)
+    x1, y1, x2, y2 = (int(c * n) for c in corners)
+    x_min, x_max = sorted([x1, x2])
+    y_min, y_max = sorted([y1, y2])
+    return (range(x_min - TILE_MARGIN, x_max + 1 + TILE_MARGIN),
+            range(y_min - TILE_MARGIN, y_max + 1 + TILE_MARGIN))
+
+def build_tile_list(bounds, zoom_levels):
+    """Enumerate every (z, x, y) tile to download for bounds across zoom_levels."""
+    corners = project_bounds(bounds)
+    tiles = []
+    # Tiles are unique within a zoom level, so repeated zoom levels are the only
+    # source of duplicates; dropping them keeps the list unique without hashing every tile.
+    for z in dict.fromkeys(zoom_levels):
+        xs, ys = tile_range(corners, z)
+        tiles.extend(product((z,), xs, ys))
+    return tiles
+
 if __name__ == '__main__':
     app.run(debug=True)